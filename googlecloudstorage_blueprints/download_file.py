@@ -1,11 +1,27 @@
 import os
 import re
 import json
-import tempfile
+import base64
+import hashlib
 import argparse
-
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+import google_crc32c
+import google.auth
 from google.cloud import storage
 from google.cloud.exceptions import *
+from requests.adapters import HTTPAdapter
+
+
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+CHUNK_SIZE = 32 * 1024 * 1024
+CHUNK_WORKERS = 8
+CHUNKED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+CHECKSUM_READ_SIZE = 1024 * 1024
 
 
 def get_args():
@@ -38,28 +54,55 @@ def get_args():
         dest='gcp_application_credentials',
         default=None,
         required=True)
+    parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=int,
+        default=CHUNK_SIZE,
+        required=False)
+    parser.add_argument(
+        '--chunk-workers',
+        dest='chunk_workers',
+        type=int,
+        default=CHUNK_WORKERS,
+        required=False)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=MAX_WORKERS,
+        required=False)
+    parser.add_argument(
+        '--checksum',
+        dest='checksum',
+        default='crc32c',
+        choices={
+            'crc32c',
+            'md5',
+            'none'},
+        required=False)
     return parser.parse_args()
 
 
 def set_environment_variables(args):
     """
-    Set GCP credentials as environment variables if they're provided via keyword
-    arguments rather than seeded as environment variables. This will override
-    system defaults.
+    Set GCP credentials as environment variables if they're provided as a path
+    to a json credentials file. This will override system defaults. Json
+    credentials provided directly are parsed and returned instead, so the
+    client can be built from them in memory without writing them to disk.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
-        return
+    if credentials.lstrip().startswith('{'):
+        try:
+            return json.loads(credentials)
+        except json.JSONDecodeError as e:
+            print(f'Invalid json credentials: {e.msg} at line {e.lineno} '
+                  f'column {e.colno}')
+            raise(e)
+
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    return
 
 
 def extract_file_name_from_source_full_path(source_full_path):
@@ -76,12 +119,10 @@ def enumerate_destination_file_name(destination_file_name, file_number=1):
     Append a number to the end of the provided destination file name.
     Only used when multiple files are matched to, preventing the destination file from being continuously overwritten.
     """
-    if re.search(r'\.', destination_file_name):
-        destination_file_name = re.sub(
-            r'\.', f'_{file_number}.', destination_file_name, 1)
-    else:
-        destination_file_name = f'{destination_file_name}_{file_number}'
-    return destination_file_name
+    name, dot, extension = destination_file_name.partition('.')
+    if dot:
+        return f'{name}_{file_number}.{extension}'
+    return f'{destination_file_name}_{file_number}'
 
 
 def determine_destination_file_name(
@@ -120,11 +161,9 @@ def combine_folder_and_file_name(folder_name, file_name):
     """
     Combine together the provided folder_name and file_name into one path variable.
     """
-    combined_name = os.path.normpath(
-        f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
-
-    return combined_name
+    if not folder_name:
+        return os.path.normpath(file_name)
+    return os.path.normpath(f'{folder_name}/{file_name}')
 
 
 def determine_destination_name(
@@ -146,50 +185,164 @@ def determine_destination_name(
 
 def find_google_cloud_storage_file_names(bucket, prefix=''):
     """
-    Fetched all the files in the bucket which are returned in a list as
+    Fetches all the files in the bucket, lazily returned page by page as
     Google Blob objects
     """
-    return list(bucket.list_blobs(prefix=prefix))
+    return bucket.list_blobs(prefix=prefix)
 
 
-def find_matching_files(file_blobs, file_name_re):
+def extract_literal_prefix(pattern):
     """
-    Return a list of all file_names that matched the regular expression.
+    Return the literal text that every match of a compiled regular expression
+    must start with. Only patterns anchored with '^' or '\\A' have one, since
+    matching searches anywhere in the file name.
     """
-    matching_file_names = []
-    for blob in file_blobs:
-        if re.search(file_name_re, blob.name):
-            matching_file_names.append(blob)
+    if pattern.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+    nodes = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    if not nodes or nodes[0] not in (
+            (sre_parse.AT, sre_parse.AT_BEGINNING),
+            (sre_parse.AT, sre_parse.AT_BEGINNING_STRING)):
+        return ''
+
+    literal_prefix = []
+    for op, value in nodes[1:]:
+        if op is not sre_parse.LITERAL:
+            break
+        literal_prefix.append(chr(value))
+    return ''.join(literal_prefix)
+
+
+def determine_list_prefix(folder_name, pattern):
+    """
+    Narrow the prefix used to list the bucket to the literal start of the
+    pattern when it is more specific than the folder, so fewer files have to
+    be listed and matched.
+    """
+    literal_prefix = extract_literal_prefix(pattern)
+    if literal_prefix.startswith(folder_name):
+        return literal_prefix
+    return folder_name
+
 
-    return matching_file_names
+def find_matching_files(file_blobs, pattern):
+    """
+    Yield each blob whose name matches the compiled regular expression.
+    """
+    for blob in file_blobs:
+        if pattern.search(blob.name):
+            yield blob
 
 
-def download_google_cloud_storage_file(blob, destination_file_name=None):
+def verify_downloaded_file(blob, local_path, checksum='crc32c'):
+    """
+    Compare the checksum of a downloaded file against the one Google Cloud
+    Storage reports for the blob. Composite objects have no md5, so crc32c
+    is checked for them instead. A file that does not match is deleted.
+    """
+    if checksum == 'md5' and blob.md5_hash:
+        hasher, expected_checksum = hashlib.md5(), blob.md5_hash
+    else:
+        hasher, expected_checksum = google_crc32c.Checksum(), blob.crc32c
+
+    with open(local_path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(CHECKSUM_READ_SIZE), b''):
+            hasher.update(chunk)
+    actual_checksum = base64.b64encode(hasher.digest()).decode('utf-8')
+
+    if actual_checksum != expected_checksum:
+        os.remove(local_path)
+        print(f'Checksum mismatch while downloading {blob.bucket.name}/'
+              f'{blob.name}: expected {expected_checksum}, got '
+              f'{actual_checksum}')
+        raise ValueError(f'Checksum mismatch for {blob.name}')
+
+
+def download_google_cloud_storage_file(
+        blob,
+        destination_file_name=None,
+        chunk_size=CHUNK_SIZE,
+        chunk_workers=CHUNK_WORKERS,
+        checksum='crc32c'):
     """
     Download a selected file from Google Cloud Storage to local storage in
-    the current working directory.
+    the current working directory. Files larger than
+    CHUNKED_DOWNLOAD_THRESHOLD are fetched as concurrent byte-range requests
+    and checked against the whole-object checksum once they are written.
     """
-    local_path = os.path.normpath(f'{os.getcwd()}/{destination_file_name}')
-
-    blob.download_to_filename(local_path)
+    local_path = os.path.abspath(destination_file_name)
+
+    if blob.size and blob.size > CHUNKED_DOWNLOAD_THRESHOLD:
+        # Imported here because the module warns that it is a preview
+        # feature on import, which small downloads never need.
+        from google.cloud.storage import transfer_manager
+        transfer_manager.download_chunks_concurrently(
+            blob,
+            local_path,
+            chunk_size=chunk_size,
+            worker_type=transfer_manager.THREAD,
+            max_workers=chunk_workers)
+        if checksum:
+            verify_downloaded_file(blob, local_path, checksum)
+    else:
+        blob.download_to_filename(local_path, checksum=checksum)
 
     print(f'{blob.bucket.name}/{blob.name} successfully downloaded to {local_path}')
 
     return
 
 
-def get_gclient(args):
+def download_google_cloud_storage_file_after(previous_download, **kwargs):
+    """
+    Wait for an earlier download to the same local file to finish, then
+    download over it, so the two never write the file at the same time.
+    """
+    wait([previous_download])
+    download_google_cloud_storage_file(**kwargs)
+
+
+def check_crc32c_implementation(checksum):
+    """
+    Warn when crc32c checksums would be computed by the pure python fallback
+    of google-crc32c, which is slow enough to bottleneck large downloads.
+    """
+    if checksum == 'crc32c' and google_crc32c.implementation != 'c':
+        print('Warning: the google-crc32c C extension is not installed, so '
+              'crc32c checksums will be computed in pure python. Reinstall '
+              'google-crc32c for your platform or use --checksum md5.')
+
+
+def get_gclient(args, credentials_info=None):
     """
-    Attempts to create the Google Cloud Storage Client with the associated
-    environment variables
+    Attempts to create the Google Cloud Storage Client from credentials_info,
+    or from the associated environment variables if it is not provided. The
+    client's connection pool is sized so every concurrent download, and each
+    of its chunk workers, reuses an open connection instead of paying for a
+    new TLS handshake each time.
     """
     try:
-        gclient = storage.Client()
+        if credentials_info:
+            credentials, project = google.auth.load_credentials_from_dict(
+                credentials_info)
+            gclient = storage.Client(credentials=credentials, project=project)
+        else:
+            gclient = storage.Client()
     except Exception as e:
-        print(f'Error accessing Google Cloud Storage with service account '
-              f'{args.gcp_application_credentials}')
+        if credentials_info:
+            print('Error accessing Google Cloud Storage with the provided json '
+                  'credentials')
+        else:
+            print(f'Error accessing Google Cloud Storage with service account '
+                  f'{args.gcp_application_credentials}')
         raise(e)
 
+    pool_size = args.max_concurrency * args.chunk_workers
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=3)
+    gclient._http.mount('https://', adapter)
+
     return gclient
 
 
@@ -217,23 +370,23 @@ def get_storage_blob(bucket, source_folder_name, source_file_name):
     if source_folder_name != '':
         source_path = f'{source_folder_name}/{source_file_name}'
     blob = bucket.get_blob(source_path)
-    try:
-        blob.exists()
-        return blob
-    except Exception as e:
+    if blob is None:
         print(f'File {source_path} does not exist')
-        raise(e)
+        raise NotFound(source_path)
+    return blob
 
 
 def main():
     args = get_args()
-    tmp_file = set_environment_variables(args)
+    credentials_info = set_environment_variables(args)
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
     source_folder_name = clean_folder_name(args.source_folder_name)
     source_full_path = combine_folder_and_file_name(
         folder_name=source_folder_name, file_name=source_file_name)
     source_file_name_match_type = args.source_file_name_match_type
+    checksum = None if args.checksum == 'none' else args.checksum
+    check_crc32c_implementation(checksum)
     gcp_application_credentials = args.gcp_application_credentials
 
     destination_folder_name = clean_folder_name(args.destination_folder_name)
@@ -241,25 +394,54 @@ def main():
             (destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    gclient = get_gclient(args)
+    gclient = get_gclient(args, credentials_info)
     bucket = get_bucket(gclient=gclient, bucket_name=bucket_name)
 
     if source_file_name_match_type == 'regex_match':
+        pattern = re.compile(source_file_name)
         file_names = find_google_cloud_storage_file_names(
-            bucket=bucket, prefix=source_folder_name)
-        matching_file_names = find_matching_files(file_names,
-                                                  re.compile(source_file_name))
-        print(f'{len(matching_file_names)} files found. Preparing to download...')
-
-        for index, blob in enumerate(matching_file_names):
-            destination_name = determine_destination_name(
-                destination_folder_name=destination_folder_name,
-                destination_file_name=args.destination_file_name,
-                source_full_path=blob.name, file_number=index + 1)
-
-            print(f'Downloading file {index+1} of {len(matching_file_names)}')
-            download_google_cloud_storage_file(
-                blob=blob, destination_file_name=destination_name)
+            bucket=bucket,
+            prefix=determine_list_prefix(source_folder_name, pattern))
+        matching_file_names = find_matching_files(file_names, pattern)
+
+        # Matches in different folders can share a local file name. The last
+        # listed blob must end up in each file, as a sequential run would
+        # leave it, so an earlier download to the same file is cancelled if
+        # it has not started, and waited for otherwise.
+        downloads = {}
+        with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+            for index, blob in enumerate(matching_file_names):
+                destination_name = determine_destination_name(
+                    destination_folder_name=destination_folder_name,
+                    destination_file_name=args.destination_file_name,
+                    source_full_path=blob.name, file_number=index + 1)
+                download_kwargs = dict(
+                    blob=blob,
+                    destination_file_name=destination_name,
+                    chunk_size=args.chunk_size,
+                    chunk_workers=args.chunk_workers,
+                    checksum=checksum)
+                local_path = os.path.abspath(destination_name)
+                previous_download = downloads.get(local_path)
+                if previous_download is None or previous_download.cancel():
+                    downloads[local_path] = executor.submit(
+                        download_google_cloud_storage_file, **download_kwargs)
+                else:
+                    downloads[local_path] = executor.submit(
+                        download_google_cloud_storage_file_after,
+                        previous_download, **download_kwargs)
+            futures = list(downloads.values())
+            total = len(futures)
+            print(f'{total} files found. Downloading...')
+
+            for index, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise
+                print(f'Downloaded file {index+1} of {total}')
     else:
         blob = get_storage_blob(bucket=bucket,
                                 source_folder_name=source_folder_name,
@@ -270,10 +452,11 @@ def main():
             source_full_path=source_full_path)
 
         download_google_cloud_storage_file(
-            blob=blob, destination_file_name=destination_name)
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
+            blob=blob,
+            destination_file_name=destination_name,
+            chunk_size=args.chunk_size,
+            chunk_workers=args.chunk_workers,
+            checksum=checksum)
 
 
 if __name__ == '__main__':
@@ -1,18 +1,28 @@
 import os
 import re
 import json
-import tempfile
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 import shipyard_utils as shipyard
+import google.auth
 from google.cloud import storage
-# from google.cloud.exceptions import *
+from google.cloud.exceptions import NotFound
+from requests.adapters import HTTPAdapter
 try:
     import exit_codes as ec
 except BaseException:
     from . import exit_codes as ec
 
 
+MAX_WORKERS = 16
+BATCH_SIZE = 100
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--source-bucket-name', dest='source_bucket_name', required=True)
@@ -44,36 +54,86 @@ def get_args():
         dest='gcp_application_credentials',
         default=None,
         required=True)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=MAX_WORKERS,
+        required=False)
     return parser.parse_args()
 
 
 def set_environment_variables(args):
     """
-    Set GCP credentials as environment variables if they're provided via keyword
-    arguments rather than seeded as environment variables. This will override
-    system defaults.
+    Set GCP credentials as environment variables if they're provided as a path
+    to a json credentials file. This will override system defaults. Json
+    credentials provided directly are parsed and returned instead, so the
+    client can be built from them in memory without writing them to disk.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
-        return
+    if credentials.lstrip().startswith('{'):
+        try:
+            return json.loads(credentials)
+        except json.JSONDecodeError as e:
+            print(f'Invalid json credentials: {e.msg} at line {e.lineno} '
+                  f'column {e.colno}')
+            sys.exit(ec.EXIT_CODE_INVALID_CREDENTIALS)
+
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    return
+
+
+def find_google_cloud_storage_file_names(bucket, prefix='', fields=None):
+    """
+    Fetches all the files in the bucket, lazily returned page by page as
+    Google Blob objects. Pass fields to limit which metadata is returned
+    for each file.
+    """
+    return bucket.list_blobs(prefix=prefix, fields=fields)
+
+
+def find_matching_files(file_blobs, pattern):
+    """
+    Return a list of all blobs whose name matched the compiled regular
+    expression. The list is built before anything is moved, so files moved
+    into the listed prefix are never matched twice.
+    """
+    return [blob for blob in file_blobs if pattern.search(blob.name)]
+
+
+def extract_literal_prefix(pattern):
+    """
+    Return the literal text that every match of a compiled regular expression
+    must start with. Only patterns anchored with '^' or '\\A' have one, since
+    matching searches anywhere in the file name.
+    """
+    if pattern.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+    nodes = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    if not nodes or nodes[0] not in (
+            (sre_parse.AT, sre_parse.AT_BEGINNING),
+            (sre_parse.AT, sre_parse.AT_BEGINNING_STRING)):
+        return ''
 
+    literal_prefix = []
+    for op, value in nodes[1:]:
+        if op is not sre_parse.LITERAL:
+            break
+        literal_prefix.append(chr(value))
+    return ''.join(literal_prefix)
 
-def find_google_cloud_storage_file_names(bucket, prefix=''):
+
+def determine_list_prefix(folder_name, pattern):
     """
-    Fetched all the files in the bucket which are returned in a list as
-    Google Blob objects
+    Narrow the prefix used to list the bucket to the literal start of the
+    pattern when it is more specific than the folder, so fewer files have to
+    be listed and matched.
     """
-    return list(bucket.list_blobs(prefix=prefix))
+    literal_prefix = extract_literal_prefix(pattern)
+    if literal_prefix.startswith(folder_name):
+        return literal_prefix
+    return folder_name
 
 
 def download_google_cloud_storage_file(blob, destination_file_name=None):
@@ -90,18 +150,36 @@ def download_google_cloud_storage_file(blob, destination_file_name=None):
     return
 
 
-def get_gclient(args):
+def get_gclient(args, credentials_info=None):
     """
-    Attempts to create the Google Cloud Storage Client with the associated
-    environment variables
+    Attempts to create the Google Cloud Storage Client from credentials_info,
+    or from the associated environment variables if it is not provided. The
+    client's connection pool is sized to max_concurrency so concurrent
+    requests reuse open connections instead of paying for a new TLS
+    handshake each time.
     """
     try:
-        gclient = storage.Client()
+        if credentials_info:
+            credentials, project = google.auth.load_credentials_from_dict(
+                credentials_info)
+            gclient = storage.Client(credentials=credentials, project=project)
+        else:
+            gclient = storage.Client()
     except Exception:
-        print(f'Error accessing Google Cloud Storage with service account ',
-              f'{args.gcp_application_credentials}')
+        if credentials_info:
+            print('Error accessing Google Cloud Storage with the provided json '
+                  'credentials')
+        else:
+            print(f'Error accessing Google Cloud Storage with service account ',
+                  f'{args.gcp_application_credentials}')
         sys.exit(ec.EXIT_CODE_INVALID_CREDENTIALS)
 
+    adapter = HTTPAdapter(
+        pool_connections=args.max_concurrency,
+        pool_maxsize=args.max_concurrency,
+        max_retries=3)
+    gclient._http.mount('https://', adapter)
+
     return gclient
 
 
@@ -129,23 +207,18 @@ def get_storage_blob(bucket, source_folder_name, source_file_name):
     if source_folder_name != '':
         source_path = f'{source_folder_name}/{source_file_name}'
     blob = bucket.get_blob(source_path)
-    try:
-        blob.exists()
-        return blob
-    except Exception as e:
+    if blob is None:
         print(f'File {source_path} does not exist')
         sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+    return blob
 
 
-def move_google_cloud_storage_file(source_bucket, source_blob_path, 
+def move_google_cloud_storage_file(source_bucket, source_blob,
                                 destination_bucket, destination_blob_path):
     """
     Moves blobs between directories or buckets. First copies the  
     blob to destination then deletes the source blob from the old location.
     """
-    # get source blob
-    source_blob = source_bucket.blob(source_blob_path)
-
     # copy to destination
     dest_blob = source_bucket.copy_blob(
         source_blob, destination_bucket, destination_blob_path)
@@ -155,9 +228,42 @@ def move_google_cloud_storage_file(source_bucket, source_blob_path,
     print(f'File moved from {source_blob} to {dest_blob}')
 
 
+def copy_google_cloud_storage_file(source_bucket, source_blob,
+                                   destination_bucket, destination_blob_path):
+    """
+    Copies a blob to the destination without deleting it, returning the
+    source blob so it can be deleted once every copy has succeeded.
+    """
+    dest_blob = source_bucket.copy_blob(
+        source_blob, destination_bucket, destination_blob_path)
+
+    print(f'File copied from {source_blob} to {dest_blob}')
+    return source_blob
+
+
+def delete_google_cloud_storage_files(gclient, blobs):
+    """
+    Deletes blobs with one batch request per BATCH_SIZE blobs. If a batch
+    fails, its blobs are deleted one request at a time instead.
+    """
+    for start in range(0, len(blobs), BATCH_SIZE):
+        batch_blobs = blobs[start:start + BATCH_SIZE]
+        try:
+            with gclient.batch():
+                for blob in batch_blobs:
+                    blob.delete()
+        except Exception as e:
+            print(f'Batch delete failed, deleting files individually\n {e}')
+            for blob in batch_blobs:
+                try:
+                    blob.delete()
+                except NotFound:
+                    pass
+
+
 def main():
     args = get_args()
-    tmp_file = set_environment_variables(args)
+    credentials_info = set_environment_variables(args)
     source_bucket_name = args.source_bucket_name
     destination_bucket_name = args.destination_bucket_name
     source_file_name = args.source_file_name
@@ -167,33 +273,71 @@ def main():
     destination_folder_name = shipyard.files.clean_folder_name(args.destination_folder_name)
     destination_file_name = args.destination_file_name
 
-    gclient = get_gclient(args)
+    gclient = get_gclient(args, credentials_info)
     source_bucket = get_bucket(gclient=gclient, bucket_name=source_bucket_name)
     destination_bucket = get_bucket(gclient=gclient, bucket_name=destination_bucket_name)
     if source_file_name_match_type == 'regex_match':
         try:
+            pattern = re.compile(source_file_name)
             blobs = find_google_cloud_storage_file_names(
-                bucket=source_bucket, prefix=source_folder_name)
-            file_names = list(map(lambda x: x.name,blobs))
-            matching_file_names = shipyard.files.find_all_file_matches(file_names,re.compile(source_file_name))
+                bucket=source_bucket,
+                prefix=determine_list_prefix(source_folder_name, pattern),
+                fields='items(name),nextPageToken')
+            matching_file_names = find_matching_files(blobs, pattern)
             
-            print(f'{len(matching_file_names)} files found. Preparing to move...')
+            total = len(matching_file_names)
+            print(f'{total} files found. Preparing to move...')
         except Exception as e:
             print(f"Error in finding regex matches. Please make sure a valid regex is entered")
             sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
 
-        for index, blob in enumerate(matching_file_names,1):
-            destination_full_path = shipyard.files.determine_destination_full_path(
+        destination_full_paths = [
+            shipyard.files.determine_destination_full_path(
                 destination_folder_name = destination_folder_name,
                 destination_file_name = destination_file_name,
-                source_full_path = blob,
-                file_number= None if len(matching_file_names) == 1 else index
-            )
-            print(f'moving file {index} of {len(matching_file_names)}')
-            move_google_cloud_storage_file(
-                source_bucket=source_bucket, source_blob_path=blob,
-                destination_bucket=destination_bucket, destination_blob_path=destination_full_path
+                source_full_path = blob.name,
+                file_number= None if total == 1 else index
             )
+            for index, blob in enumerate(matching_file_names,1)]
+
+        # Within one bucket, a file can be moved onto itself or onto another
+        # matched file. Moving onto itself is refused, and a source that is
+        # also a destination is kept, since deleting it afterwards would
+        # delete the file that was just moved there.
+        moves = list(zip(matching_file_names, destination_full_paths))
+        kept_source_names = set()
+        if source_bucket.name == destination_bucket.name:
+            kept_source_names = set(destination_full_paths)
+            for blob, destination_full_path in moves:
+                if blob.name == destination_full_path:
+                    print(f'Skipping {blob.name}, it would be moved onto itself')
+            moves = [
+                (blob, destination_full_path)
+                for blob, destination_full_path in moves
+                if blob.name != destination_full_path]
+
+        source_blobs = []
+        with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+            futures = [
+                executor.submit(
+                    copy_google_cloud_storage_file,
+                    source_bucket, blob, destination_bucket, destination_full_path)
+                for blob, destination_full_path in moves]
+            for index, future in enumerate(as_completed(futures), 1):
+                try:
+                    source_blobs.append(future.result())
+                except Exception:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise
+                print(f'copied file {index} of {len(futures)}')
+
+        source_blobs = [
+            blob for blob in source_blobs
+            if blob.name not in kept_source_names]
+        print(f'Deleting {len(source_blobs)} moved files from their source '
+              f'location')
+        delete_google_cloud_storage_files(gclient, source_blobs)
     else:
         
         blob = get_storage_blob(bucket=source_bucket,
@@ -205,13 +349,14 @@ def main():
             destination_file_name = dest_file,
             source_full_path = blob
         ) 
+        if source_bucket.name == destination_bucket.name and \
+                blob.name == destination_full_path:
+            print(f'Skipping {blob.name}, it would be moved onto itself')
+            return
         move_google_cloud_storage_file(
-            source_bucket=source_bucket, source_blob_path=blob.name,
+            source_bucket=source_bucket, source_blob=blob,
             destination_bucket=destination_bucket, destination_blob_path=destination_full_path
         )
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
 
 
 if __name__ == '__main__':
@@ -2,17 +2,28 @@ import os
 import json
 import argparse
 import re
-import tempfile
 import sys
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 import shipyard_utils as shipyard
+import google.auth
 from google.cloud import storage
 from google.cloud.exceptions import *
+from requests.adapters import HTTPAdapter
 try:
     import exit_codes as ec
 except BaseException:
     from . import exit_codes as ec
 
 
+MAX_WORKERS = 16
+BATCH_SIZE = 100
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--bucket-name', dest='bucket_name', required=True)
@@ -33,51 +44,109 @@ def get_args():
         dest='gcp_application_credentials',
         default=None,
         required=True)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=MAX_WORKERS,
+        required=False)
     return parser.parse_args()
 
 
 def set_environment_variables(args):
     """
-    Set GCP credentials as environment variables if they're provided via keyword
-    arguments rather than seeded as environment variables. This will override
-    system defaults.
+    Set GCP credentials as environment variables if they're provided as a path
+    to a json credentials file. This will override system defaults. Json
+    credentials provided directly are parsed and returned instead, so the
+    client can be built from them in memory without writing them to disk.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
-        return
+    if credentials.lstrip().startswith('{'):
+        try:
+            return json.loads(credentials)
+        except json.JSONDecodeError as e:
+            print(f'Invalid json credentials: {e.msg} at line {e.lineno} '
+                  f'column {e.colno}')
+            sys.exit(ec.EXIT_CODE_INVALID_CREDENTIALS)
+
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    return
 
 
-def find_google_cloud_storage_file_names(bucket, prefix=''):
+def find_google_cloud_storage_file_names(bucket, prefix='', fields=None):
     """
-    Fetched all the files in the bucket which are returned in a list as
-    Google Blob objects
+    Fetches all the files in the bucket, lazily returned page by page as
+    Google Blob objects. Pass fields to limit which metadata is returned
+    for each file.
     """
-    return list(bucket.list_blobs(prefix=prefix))
+    return bucket.list_blobs(prefix=prefix, fields=fields)
 
 
+def extract_literal_prefix(pattern):
+    """
+    Return the literal text that every match of a compiled regular expression
+    must start with. Only patterns anchored with '^' or '\\A' have one, since
+    matching searches anywhere in the file name.
+    """
+    if pattern.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+    nodes = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    if not nodes or nodes[0] not in (
+            (sre_parse.AT, sre_parse.AT_BEGINNING),
+            (sre_parse.AT, sre_parse.AT_BEGINNING_STRING)):
+        return ''
+
+    literal_prefix = []
+    for op, value in nodes[1:]:
+        if op is not sre_parse.LITERAL:
+            break
+        literal_prefix.append(chr(value))
+    return ''.join(literal_prefix)
+
 
-def get_gclient(args):
+def determine_list_prefix(folder_name, pattern):
     """
-    Attempts to create the Google Cloud Storage Client with the associated
-    environment variables
+    Narrow the prefix used to list the bucket to the literal start of the
+    pattern when it is more specific than the folder, so fewer files have to
+    be listed and matched.
+    """
+    literal_prefix = extract_literal_prefix(pattern)
+    if literal_prefix.startswith(folder_name):
+        return literal_prefix
+    return folder_name
+
+
+def get_gclient(args, credentials_info=None):
+    """
+    Attempts to create the Google Cloud Storage Client from credentials_info,
+    or from the associated environment variables if it is not provided. The
+    client's connection pool is sized to max_concurrency so concurrent
+    requests reuse open connections instead of paying for a new TLS
+    handshake each time.
     """
     try:
-        gclient = storage.Client()
+        if credentials_info:
+            credentials, project = google.auth.load_credentials_from_dict(
+                credentials_info)
+            gclient = storage.Client(credentials=credentials, project=project)
+        else:
+            gclient = storage.Client()
     except Exception:
-        print(f'Error accessing Google Cloud Storage with service account '
-              f'{args.gcp_application_credentials}')
+        if credentials_info:
+            print('Error accessing Google Cloud Storage with the provided json '
+                  'credentials')
+        else:
+            print(f'Error accessing Google Cloud Storage with service account '
+                  f'{args.gcp_application_credentials}')
         sys.exit(ec.EXIT_CODE_INVALID_CREDENTIALS)
 
+    adapter = HTTPAdapter(
+        pool_connections=args.max_concurrency,
+        pool_maxsize=args.max_concurrency,
+        max_retries=3)
+    gclient._http.mount('https://', adapter)
+
     return gclient
 
 
@@ -105,12 +174,10 @@ def get_storage_blob(bucket, source_folder_name, source_file_name):
     if source_folder_name != '':
         source_path = f'{source_folder_name}/{source_file_name}'
     blob = bucket.get_blob(source_path)
-    try:
-        blob.exists()
-        return blob
-    except Exception as e:
+    if blob is None:
         print(f'File {source_path} does not exist')
         sys.exit(ec.EXIT_CODE_FILE_NOT_FOUND)
+    return blob
 
 
 
@@ -123,47 +190,87 @@ def delete_google_cloud_storage_file(blob):
     print(f"Blob {blob_bucket}/{blob_name} delete ran successfully")
 
 
-def gcp_find_matching_files(file_blobs, file_name_re):
+def delete_google_cloud_storage_batch(gclient, bucket, file_names):
+    """
+    Deletes the selected files from Google Cloud Storage with a single
+    batch request. If the batch fails, the files are deleted one request
+    at a time instead. Returns the number of files deleted.
+    """
+    try:
+        with gclient.batch():
+            for file_name in file_names:
+                bucket.delete_blob(file_name)
+    except Exception as e:
+        print(f'Batch delete failed, deleting files individually\n {e}')
+        for file_name in file_names:
+            try:
+                bucket.delete_blob(file_name)
+            except NotFound:
+                pass
+    return len(file_names)
+
+
+def delete_google_cloud_storage_files(gclient, bucket, file_names,
+                                      max_concurrency=MAX_WORKERS):
     """
-    Return a list of all file_names that matched the regular expression.
+    Deletes files with one batch request per BATCH_SIZE files, sending up to
+    max_concurrency batches at once. File names are consumed lazily, so
+    deletes start before a streamed listing finishes.
     """
-    matching_file_names = []
-    for blob in file_blobs:
-        if re.search(file_name_re, blob.name):
-            matching_file_names.append(blob)
+    file_names = iter(file_names)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = []
+        matched_count = 0
+        batch_file_names = list(itertools.islice(file_names, BATCH_SIZE))
+        while batch_file_names:
+            futures.append(executor.submit(
+                delete_google_cloud_storage_batch,
+                gclient, bucket, batch_file_names))
+            matched_count += len(batch_file_names)
+            batch_file_names = list(itertools.islice(file_names, BATCH_SIZE))
+        print(f'{matched_count} files found. Deleting...')
+
+        deleted_count = 0
+        for future in as_completed(futures):
+            deleted_count += future.result()
+            print(f'deleted {deleted_count} of {matched_count} files')
 
-    return matching_file_names
+
+def find_matching_names(file_blobs, pattern):
+    """
+    Yield the name of each blob that matches the compiled regular
+    expression. Names are projected out first so the match itself is a
+    plain string filter.
+    """
+    return filter(pattern.search, (blob.name for blob in file_blobs))
 
 
 def main():
     args = get_args()
-    tmp_file = set_environment_variables(args)
+    credentials_info = set_environment_variables(args)
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
     source_folder_name = shipyard.files.clean_folder_name(args.source_folder_name)
     source_file_name_match_type = args.source_file_name_match_type
 
-    gclient = get_gclient(args)
+    gclient = get_gclient(args, credentials_info)
     bucket = get_bucket(gclient=gclient, bucket_name=bucket_name)
 
     if source_file_name_match_type == 'regex_match':
+        pattern = re.compile(source_file_name)
         file_names = find_google_cloud_storage_file_names(
-            bucket=bucket, prefix=source_folder_name)
-        matching_file_names = gcp_find_matching_files(file_names,
-                                                  re.compile(source_file_name))
-        print(f'{len(matching_file_names)} files found. Preparing to delete...')
-
-        for index, blob in enumerate(matching_file_names):
-            print(f'deleting file {index+1} of {len(matching_file_names)}')
-            delete_google_cloud_storage_file(blob=blob)
+            bucket=bucket,
+            prefix=determine_list_prefix(source_folder_name, pattern),
+            fields='items(name),nextPageToken')
+        matching_file_names = find_matching_names(file_names, pattern)
+        delete_google_cloud_storage_files(
+            gclient, bucket, matching_file_names,
+            max_concurrency=args.max_concurrency)
     else:
         blob = get_storage_blob(bucket=bucket,
                                 source_folder_name=source_folder_name,
                                 source_file_name=source_file_name)
         delete_google_cloud_storage_file(blob=blob)
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,32 @@
+import io
 import os
 import re
 import json
-import tempfile
+import base64
 import argparse
-import glob
-
+import mimetypes
+import posixpath
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import google_crc32c
+import shipyard_utils as shipyard
+import google.auth
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.cloud.exceptions import *
+from requests.adapters import HTTPAdapter
 
 
+MAX_WORKERS = 16
 CHUNK_SIZE = 128 * 1024 * 1024
+CONCURRENT_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+SINGLE_REQUEST_UPLOAD_SIZE = 8 * 1024 * 1024
+COMPOSITE_UPLOAD_SIZE = 256 * 1024 * 1024
+COMPOSITE_UPLOAD_SHARDS = 32
+CHECKSUM_READ_SIZE = 1024 * 1024
 
 
 def get_args():
@@ -41,28 +58,50 @@ def get_args():
         dest='gcp_application_credentials',
         default=None,
         required=True)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=MAX_WORKERS,
+        required=False)
+    parser.add_argument(
+        '--skip-unchanged-files',
+        dest='skip_unchanged_files',
+        default='FALSE',
+        choices={
+            'TRUE',
+            'FALSE'},
+        required=False)
+    parser.add_argument(
+        '--composite-upload',
+        dest='composite_upload',
+        default='FALSE',
+        choices={
+            'TRUE',
+            'FALSE'},
+        required=False)
     return parser.parse_args()
 
 
 def set_environment_variables(args):
     """
-    Set GCP credentials as environment variables if they're provided via keyword
-    arguments rather than seeded as environment variables. This will override
-    system defaults.
+    Set GCP credentials as environment variables if they're provided as a path
+    to a json credentials file. This will override system defaults. Json
+    credentials provided directly are parsed and returned instead, so the
+    client can be built from them in memory without writing them to disk.
     """
     credentials = args.gcp_application_credentials
-    try:
-        json_credentials = json.loads(credentials)
-        fd, path = tempfile.mkstemp()
-        print(f'Storing json credentials temporarily at {path}')
-        with os.fdopen(fd, 'w') as tmp:
-            tmp.write(credentials)
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
-        return path
-    except Exception:
-        print('Using specified json credentials file')
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
-        return
+    if credentials.lstrip().startswith('{'):
+        try:
+            return json.loads(credentials)
+        except json.JSONDecodeError as e:
+            print(f'Invalid json credentials: {e.msg} at line {e.lineno} '
+                  f'column {e.colno}')
+            raise(e)
+
+    print('Using specified json credentials file')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials
+    return
 
 
 def extract_file_name_from_source_full_path(source_full_path):
@@ -80,12 +119,9 @@ def enumerate_destination_file_name(destination_file_name, file_number=1):
     Only used when multiple files are matched to, preventing the destination
     file from being continuously overwritten.
     """
-    if re.search(r'\.', destination_file_name):
-        destination_file_name = re.sub(
-            r'\.', f'_{file_number}.', destination_file_name, 1)
-    else:
-        destination_file_name = f'{destination_file_name}_{file_number}'
-    return destination_file_name
+    name_destination_file = create_destination_file_namer(
+        destination_file_name)
+    return name_destination_file(destination_file_name, file_number)
 
 
 def determine_destination_file_name(
@@ -111,27 +147,60 @@ def determine_destination_file_name(
     return destination_file_name
 
 
+def create_destination_file_namer(destination_file_name):
+    """
+    Returns a function that names the destination of each matched file from
+    its source path and 1-based position. The choice between enumerating
+    destination_file_name and keeping the source file name is made once here,
+    and destination_file_name is split around its extension once, rather
+    than for every file.
+    """
+    if destination_file_name:
+        name, dot, extension = destination_file_name.partition('.')
+
+        def name_destination_file(source_full_path, file_number):
+            return f'{name}_{file_number}{dot}{extension}'
+    else:
+        def name_destination_file(source_full_path, file_number):
+            return extract_file_name_from_source_full_path(source_full_path)
+
+    return name_destination_file
+
+
+def is_normalized_path(path):
+    """
+    Check whether posixpath.normpath would leave path unchanged, which is the
+    case unless it contains '//', a '.' or '..' segment, or a trailing '/'.
+    """
+    return not (
+        '//' in path
+        or '/./' in f'/{path}/'
+        or '/../' in f'/{path}/'
+        or path.endswith('/'))
+
+
 def clean_folder_name(folder_name):
     """
     Cleans folders name by removing duplicate '/' as well as leading and
     trailing '/' characters.
     """
     folder_name = folder_name.strip('/')
-    if folder_name != '':
-        folder_name = os.path.normpath(folder_name)
+    if not is_normalized_path(folder_name):
+        folder_name = posixpath.normpath(folder_name)
     return folder_name
 
 
 def combine_folder_and_file_name(folder_name, file_name):
     """
     Combine together the provided folder_name and file_name into one path
-    variable.
+    variable. GCS object names always use '/', regardless of the local
+    platform.
     """
-    combined_name = os.path.normpath(
-        f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
-
-    return combined_name
+    if not folder_name:
+        if is_normalized_path(file_name):
+            return file_name
+        return posixpath.normpath(file_name)
+    return posixpath.normpath(f'{folder_name}/{file_name}')
 
 
 def determine_destination_full_path(
@@ -151,57 +220,317 @@ def determine_destination_full_path(
     return destination_full_path
 
 
-def find_all_local_file_names(source_folder_name):
+def find_all_file_matches(cwd, source_folder_name, file_name_re):
     """
-    Returns a list of all files that exist in the current working directory,
-    filtered by source_folder_name if provided.
+    Walks the current working directory, filtered by source_folder_name if
+    provided, and yields the path of every file that matches the compiled
+    regular expression. Hidden files and folders are skipped, as glob does,
+    and folders that cannot be read are passed over.
     """
-    cwd = os.getcwd()
-    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}/**')
-    file_names = glob.glob(cwd_extension, recursive=True)
-    return file_names
+    search = file_name_re.search
+    folder_names = [os.path.normpath(f'{cwd}/{source_folder_name}')]
+    while folder_names:
+        try:
+            entries = os.scandir(folder_names.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    folder_names.append(entry.path)
+                elif search(entry.path):
+                    yield entry.path
+
+
+def determine_chunk_size(file_size, max_chunk_size=CHUNK_SIZE):
+    """
+    Pick the upload chunk size for a file of file_size bytes. Small files are
+    sent in a single request with no chunk buffer. Larger files get the
+    smallest multiple of 256 KiB that holds the whole file, capped at
+    max_chunk_size. Each chunk is held in memory while it is sent.
+    """
+    if file_size <= SINGLE_REQUEST_UPLOAD_SIZE:
+        return None
+    chunk_size = -(-file_size // CHUNK_SIZE_MULTIPLE) * CHUNK_SIZE_MULTIPLE
+    return min(chunk_size, max_chunk_size)
 
 
-def find_all_file_matches(file_names, file_name_re):
+def upload_google_cloud_storage_file(
+        gclient,
+        bucket,
+        source_full_path,
+        destination_full_path,
+        large_chunk_lock=None):
     """
-    Return a list of all file_names that matched the regular expression.
+    Uploads a single file to Google Cloud Storage. Files small enough to be
+    sent in a single request are retried on transient errors, since the
+    request body is read into memory once and can simply be sent again.
+    When uploads run concurrently they share large_chunk_lock, and only the
+    upload holding it sends CHUNK_SIZE chunks, so a lone large file gets full
+    chunks while many uploads together stay within a bounded amount of memory.
     """
-    matching_file_names = []
-    for file in file_names:
-        if re.search(file_name_re, file):
-            matching_file_names.append(file)
+    content_type = mimetypes.guess_type(source_full_path)[0]
+    with open(source_full_path, 'rb') as source_file:
+        size = os.fstat(source_file.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(
+                source_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        has_large_chunks = size > CONCURRENT_CHUNK_SIZE and (
+            large_chunk_lock is None
+            or large_chunk_lock.acquire(blocking=False))
+        try:
+            chunk_size = determine_chunk_size(
+                size, CHUNK_SIZE if has_large_chunks else CONCURRENT_CHUNK_SIZE)
+            blob = bucket.blob(destination_full_path, chunk_size=chunk_size)
+            upload_kwargs = {}
+            if chunk_size is None:
+                upload_kwargs['retry'] = DEFAULT_RETRY
+            blob.upload_from_file(
+                source_file,
+                rewind=False,
+                size=size,
+                content_type=content_type,
+                **upload_kwargs)
+        finally:
+            if has_large_chunks and large_chunk_lock is not None:
+                large_chunk_lock.release()
 
-    return matching_file_names
+    print(f'{source_full_path} successfully uploaded to '
+          f'{bucket.name}/{destination_full_path}')
 
 
-def upload_google_cloud_storage_file(
+def find_existing_file_checksums(bucket, destination_folder_name):
+    """
+    List every object under destination_folder_name once and return a map of
+    object name to its (size, crc32c), so unchanged files can be skipped
+    without a request per file.
+    """
+    prefix = f'{destination_folder_name}/' if destination_folder_name else None
+    blobs = bucket.list_blobs(
+        prefix=prefix, fields='items(name,size,crc32c),nextPageToken')
+    return {blob.name: (blob.size, blob.crc32c) for blob in blobs}
+
+
+def calculate_crc32c(source_full_path):
+    """
+    Returns the base64 encoded CRC32C of a local file, in the same form
+    Google Cloud Storage reports for its objects.
+    """
+    checksum = google_crc32c.Checksum()
+    with open(source_full_path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(CHECKSUM_READ_SIZE), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def upload_changed_google_cloud_storage_file(
         gclient,
         bucket,
         source_full_path,
-        destination_full_path):
+        destination_full_path,
+        existing_checksum=None,
+        large_chunk_lock=None):
+    """
+    Uploads a single file to Google Cloud Storage unless an object with the
+    same size and CRC32C already exists at the destination. The local
+    checksum is only calculated when the sizes match.
+    """
+    if existing_checksum:
+        existing_size, existing_crc32c = existing_checksum
+        if existing_size == os.path.getsize(source_full_path) and \
+                existing_crc32c == calculate_crc32c(source_full_path):
+            print(f'{bucket.name}/{destination_full_path} is unchanged. '
+                  f'Skipping {source_full_path}')
+            return
+
+    upload_google_cloud_storage_file(
+        gclient=gclient,
+        bucket=bucket,
+        source_full_path=source_full_path,
+        destination_full_path=destination_full_path,
+        large_chunk_lock=large_chunk_lock)
+
+
+class FileShard(io.RawIOBase):
     """
-    Uploads a single file to Google Cloud Storage.
+    Read-only view of length bytes of an open file starting at offset. The
+    upload client expects streams to start at position 0, so each shard of a
+    composite upload is exposed as if it were a whole file.
     """
-    blob = bucket.blob(destination_full_path, chunk_size=CHUNK_SIZE)
-    blob.upload_from_filename(source_full_path)
+
+    def __init__(self, source_file, offset, length):
+        self._source_file = source_file
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._length
+        self._position = max(0, min(position, self._length))
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._length - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self._source_file.seek(self._offset + self._position)
+        data = self._source_file.read(size)
+        self._position += len(data)
+        return data
+
+
+def upload_google_cloud_storage_shard(
+        bucket,
+        source_full_path,
+        shard_full_path,
+        offset,
+        length):
+    """
+    Uploads length bytes of the source file, starting at offset, as a
+    temporary shard object for a composite upload.
+    """
+    blob = bucket.blob(
+        shard_full_path,
+        chunk_size=determine_chunk_size(length, CONCURRENT_CHUNK_SIZE))
+    with open(source_full_path, 'rb') as source_file:
+        blob.upload_from_file(
+            FileShard(source_file, offset, length), size=length)
+    return blob
+
+
+def delete_google_cloud_storage_shards(bucket, shard_blobs):
+    """
+    Deletes the temporary shards of a composite upload. The upload has
+    already finished by then, so a failure is reported along with the
+    shards that may be left behind instead of failing the run.
+    """
+    try:
+        bucket.delete_blobs(shard_blobs, on_error=lambda blob: None)
+    except Exception as e:
+        print(f'Warning: could not delete the temporary shards of a '
+              f'composite upload, remove them manually\n {e}')
+        for blob in shard_blobs:
+            print(f'{bucket.name}/{blob.name}')
+
+
+def parallel_composite_upload(
+        gclient,
+        bucket,
+        source_full_path,
+        destination_full_path,
+        shards=COMPOSITE_UPLOAD_SHARDS):
+    """
+    Uploads a large file to Google Cloud Storage as byte-range shards in
+    parallel, composes them into the destination object server side and
+    deletes the shards. GCS composes at most 32 objects at a time. Shard
+    names carry a random component so they never clash with existing objects.
+    If the credentials may not compose objects, the file is uploaded as a
+    single object instead.
+    """
+    file_size = os.path.getsize(source_full_path)
+    shard_size = -(-file_size // shards)
+    destination_blob = bucket.blob(destination_full_path)
+    destination_blob.content_type = mimetypes.guess_type(source_full_path)[0]
+    shard_prefix = f'{destination_full_path}.{uuid.uuid4().hex}.part'
+
+    composed = False
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        futures = [
+            executor.submit(
+                upload_google_cloud_storage_shard,
+                bucket=bucket,
+                source_full_path=source_full_path,
+                shard_full_path=f'{shard_prefix}{index}',
+                offset=offset,
+                length=min(shard_size, file_size - offset))
+            for index, offset in enumerate(range(0, file_size, shard_size))]
+        try:
+            shard_blobs = [future.result() for future in futures]
+            try:
+                destination_blob.compose(shard_blobs)
+                composed = True
+            except Forbidden as e:
+                print(f'Composing {bucket.name}/{destination_full_path} is '
+                      f'not permitted, uploading it as a single object '
+                      f'instead\n {e}')
+        finally:
+            executor.shutdown(wait=True)
+            uploaded_shards = [
+                future.result() for future in futures
+                if not future.cancelled() and future.exception() is None]
+            delete_google_cloud_storage_shards(bucket, uploaded_shards)
+
+    if not composed:
+        upload_google_cloud_storage_file(
+            gclient=gclient,
+            bucket=bucket,
+            source_full_path=source_full_path,
+            destination_full_path=destination_full_path)
+        return
 
     print(f'{source_full_path} successfully uploaded to '
-          f'{bucket.name}/{destination_full_path}')
+          f'{bucket.name}/{destination_full_path} in {len(futures)} parts')
+
+
+def check_crc32c_implementation():
+    """
+    Warn when crc32c checksums would be computed by the pure python fallback
+    of google-crc32c, which is slow enough to bottleneck comparing large files.
+    """
+    if google_crc32c.implementation != 'c':
+        print('Warning: the google-crc32c C extension is not installed, so '
+              'crc32c checksums will be computed in pure python. Reinstall '
+              'google-crc32c for your platform to speed up '
+              '--skip-unchanged-files.')
 
 
-def get_gclient(args):
+def get_gclient(args, credentials_info=None):
     """
-    Attempts to create the Google Cloud Storage Client with the associated
-    environment variables
+    Attempts to create the Google Cloud Storage Client from credentials_info,
+    or from the associated environment variables if it is not provided. The
+    client's connection pool is sized to the largest number of concurrent
+    uploads so they reuse open connections instead of paying for a new TLS
+    handshake each time.
     """
     try:
-        gclient = storage.Client()
-        return gclient
+        if credentials_info:
+            credentials, project = google.auth.load_credentials_from_dict(
+                credentials_info)
+            gclient = storage.Client(credentials=credentials, project=project)
+        else:
+            gclient = storage.Client()
     except Exception as e:
-        print(f'Error accessing Google Cloud Storage with service account '
-              f'{args.gcp_application_credentials}')
+        if credentials_info:
+            print('Error accessing Google Cloud Storage with the provided json '
+                  'credentials')
+        else:
+            print(f'Error accessing Google Cloud Storage with service account '
+                  f'{args.gcp_application_credentials}')
         raise(e)
 
+    pool_size = max(args.max_concurrency, COMPOSITE_UPLOAD_SHARDS)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=3)
+    gclient._http.mount('https://', adapter)
+
+    return gclient
+
 
 def get_bucket(*,
                gclient,
@@ -220,51 +549,88 @@ def get_bucket(*,
 
 def main():
     args = get_args()
-    tmp_file = set_environment_variables(args)
+    credentials_info = set_environment_variables(args)
+    cwd = os.getcwd()
     bucket_name = args.bucket_name
     source_file_name = args.source_file_name
     source_folder_name = args.source_folder_name
-    source_full_path = combine_folder_and_file_name(
-        folder_name=f'{os.getcwd()}/{source_folder_name}',
-        file_name=source_file_name)
+    source_full_path = os.path.normpath(
+        f'{cwd}/{source_folder_name}/{source_file_name}')
     destination_folder_name = clean_folder_name(args.destination_folder_name)
+    destination_file_name = args.destination_file_name
     source_file_name_match_type = args.source_file_name_match_type
 
-    gclient = get_gclient(args)
+    gclient = get_gclient(args, credentials_info)
     bucket = get_bucket(gclient=gclient, bucket_name=bucket_name)
 
     if source_file_name_match_type == 'regex_match':
-        file_names = find_all_local_file_names(source_folder_name)
         matching_file_names = find_all_file_matches(
-            file_names, re.compile(source_file_name))
-        print(f'{len(matching_file_names)} files found. Preparing to upload...')
-
-        for index, key_name in enumerate(matching_file_names):
-            destination_full_path = determine_destination_full_path(
-                destination_folder_name=destination_folder_name,
-                destination_file_name=args.destination_file_name,
-                source_full_path=key_name,
-                file_number=index + 1)
-            print(f'Uploading file {index+1} of {len(matching_file_names)}')
-            upload_google_cloud_storage_file(
-                source_full_path=key_name,
-                destination_full_path=destination_full_path,
-                bucket=bucket,
-                gclient=gclient)
+            cwd, source_folder_name, re.compile(source_file_name))
+
+        existing_checksums = {}
+        if shipyard.args.convert_to_boolean(args.skip_unchanged_files):
+            check_crc32c_implementation()
+            existing_checksums = find_existing_file_checksums(
+                bucket, destination_folder_name)
+
+        name_destination_file = create_destination_file_namer(
+            destination_file_name)
+        large_chunk_lock = threading.Lock()
+        upload_failed = threading.Event()
+
+        def stop_on_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                upload_failed.set()
+
+        with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+            futures = []
+            for index, key_name in enumerate(matching_file_names, 1):
+                if upload_failed.is_set():
+                    break
+                destination_full_path = combine_folder_and_file_name(
+                    destination_folder_name,
+                    name_destination_file(key_name, index))
+                future = executor.submit(
+                    upload_changed_google_cloud_storage_file,
+                    source_full_path=key_name,
+                    destination_full_path=destination_full_path,
+                    bucket=bucket,
+                    gclient=gclient,
+                    existing_checksum=existing_checksums.get(
+                        destination_full_path),
+                    large_chunk_lock=large_chunk_lock)
+                future.add_done_callback(stop_on_failure)
+                futures.append(future)
+            total = len(futures)
+            print(f'{total} files found. Uploading...')
+
+            for index, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    raise
+                print(f'Uploaded file {index} of {total}')
 
     else:
         destination_full_path = determine_destination_full_path(
             destination_folder_name=destination_folder_name,
-            destination_file_name=args.destination_file_name,
+            destination_file_name=destination_file_name,
             source_full_path=source_full_path)
-        upload_google_cloud_storage_file(
-            source_full_path=source_full_path,
-            destination_full_path=destination_full_path,
-            bucket=bucket,
-            gclient=gclient)
-    if tmp_file:
-        print(f'Removing temporary credentials file {tmp_file}')
-        os.remove(tmp_file)
+        if shipyard.args.convert_to_boolean(args.composite_upload) and \
+                os.path.getsize(source_full_path) > COMPOSITE_UPLOAD_SIZE:
+            parallel_composite_upload(
+                gclient=gclient,
+                bucket=bucket,
+                source_full_path=source_full_path,
+                destination_full_path=destination_full_path)
+        else:
+            upload_google_cloud_storage_file(
+                source_full_path=source_full_path,
+                destination_full_path=destination_full_path,
+                bucket=bucket,
+                gclient=gclient)
 
 
 if __name__ == '__main__':